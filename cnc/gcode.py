@@ -90,7 +90,7 @@ class GCode(object):
         :return: gcode objects.
         """
         line = line.upper()
-        line = re.sub(clean_pattern, '', line)
+        line = clean_pattern.sub('', line)
         if len(line) == 0:
             return None
         if line[0] == '%':
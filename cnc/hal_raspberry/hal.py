@@ -6,6 +6,8 @@ from cnc.config import *
 from cnc.sensors import thermistor
 
 US_IN_SECONDS = 1000000
+# how many pulses move() accumulates before writing them to dma buffer
+PULSES_CHUNK = 256
 
 gpio = rpgpio.GPIO()
 dma = rpgpio.DMAGPIO()
@@ -182,11 +184,11 @@ def __calibrate_private(x, y, z, invert):
             # that if program unexpectedly stops, dma will continue work not
             # long then this buffer time.
             dma.clear()
-            generate = 1000000
-            while generate > 0:
-                dma.add_pulse(pins, STEPPER_PULSE_LENGTH_US)
-                dma.add_delay(delay)
-                generate -= delay + STEPPER_PULSE_LENGTH_US
+            period = delay + STEPPER_PULSE_LENGTH_US
+            pulses_count = (1000000 + period - 1) // period
+            dma.add_pulses([pins] * pulses_count,
+                           [STEPPER_PULSE_LENGTH_US] * pulses_count,
+                           [delay] * pulses_count)
             dma.finalize_stream()
         if not dma.is_active():
             dma.run(False)
@@ -209,6 +211,34 @@ def calibrate(x, y, z):
     return __calibrate_private(x, y, z, False)  # move to endstop switch
 
 
+def __flush_pulses(gaps, masks):
+    """ Write accumulated pulses to dma buffer. Pulses are kept as two
+        parallel lists - delay before pulse and pins mask for pulse - and
+        written in batches, which is much cheaper then adding control
+        blocks one by one.
+    :param gaps: list with delay in us before each pulse, zero for no delay.
+    :param masks: list with pins bitwise mask for each pulse.
+    """
+    n = len(masks)
+    i = 0
+    while i < n:
+        if gaps[i] > 0:
+            dma.add_delay(gaps[i])
+        # find run of pulses where each following pulse has delay before it
+        j = i + 1
+        while j < n and gaps[j] > 0:
+            j += 1
+        if j - i > 1:
+            count = j - i - 1
+            dma.add_pulses(masks[i:j - 1],
+                           [STEPPER_PULSE_LENGTH_US] * count,
+                           gaps[i + 1:j])
+        dma.add_pulse(masks[j - 1], STEPPER_PULSE_LENGTH_US)
+        i = j
+    del gaps[:]
+    del masks[:]
+
+
 def move(generator):
     """ Move head to specified position
     :param generator: PulseGenerator object.
@@ -223,6 +253,11 @@ def move(generator):
     gpio.clear(STEPPERS_ENABLE_PIN)
     # 4 control blocks per 32 bytes
     bytes_per_iter = 4 * dma.control_block_size()
+    # reserve room in dma buffer for one whole pending chunk
+    reserve = bytes_per_iter * PULSES_CHUNK
+    # pending pulses as parallel lists, see __flush_pulses()
+    pending_gaps = []
+    pending_masks = []
     # prepare and run dma
     dma.clear()  # should just clear current address, but not stop current DMA
     prev = 0
@@ -233,8 +268,10 @@ def move(generator):
     k = 0
     k0 = 0
     for direction, tx, ty, tz, te in generator:
+        if len(pending_masks) >= PULSES_CHUNK:
+            __flush_pulses(pending_gaps, pending_masks)
         if current_cb is not None:
-            while dma.current_address() + bytes_per_iter >= current_cb:
+            while dma.current_address() + reserve >= current_cb:
                 time.sleep(0.001)
                 current_cb = dma.current_control_block()
                 if current_cb is None:
@@ -260,6 +297,8 @@ def move(generator):
                 pins_to_clear |= 1 << STEPPER_DIR_PIN_E
             elif te < 0:
                 pins_to_set |= 1 << STEPPER_DIR_PIN_E
+            # keep control blocks ordered, write pulses added so far first
+            __flush_pulses(pending_gaps, pending_masks)
             dma.add_set_clear(pins_to_set, pins_to_clear)
             continue
         pins = 0
@@ -277,8 +316,10 @@ def move(generator):
         if te is not None:
             pins |= STEP_PIN_MASK_E
         if k - prev > 0:
-            dma.add_delay(k - prev)
-        dma.add_pulse(pins, STEPPER_PULSE_LENGTH_US)
+            pending_gaps.append(k - prev)
+        else:
+            pending_gaps.append(0)
+        pending_masks.append(pins)
         # TODO not a precise way! pulses will set in queue, instead of crossing
         # if next pulse start during pulse length. Though it almost doesn't
         # matter for pulses with 1-2us length.
@@ -294,8 +335,10 @@ def move(generator):
                                  " {}/{}".format(nt, ng))
                     instant = False
                 else:
+                    __flush_pulses(pending_gaps, pending_masks)
                     dma.run_stream()
                     is_ran = True
+    __flush_pulses(pending_gaps, pending_masks)
     pt = time.time()
     if not is_ran:
         # after long command, we can fill short buffer, that why we may need to
@@ -2,16 +2,86 @@
 
 from .rpgpio_private import *
 
+import array
 import time
 import logging
+import struct
 import sys
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _build_pulse_cbs(dest, start, base, pins, lengths, delays, with_delays,
+                     entry_words, pulse_info, pulse_destination, pulse_length,
+                     pulse_stride, delay_info, delay_destination,
+                     delay_stride):
+    """ Scalar pulse control blocks builder. dest is an uint32 view over the
+        CMA buffer, start is word offset of the first block in it and base is
+        bus address of that block. Compiled to native code with numba when it
+        is available, otherwise add_pulses() uses the numpy broadcasting
+        backend instead of this function.
+    """
+    for i in range(pins.shape[0]):
+        o = start + i * entry_words
+        b = base + i * entry_words * 4
+        # control block 1 - set
+        dest[o] = pulse_info
+        dest[o + 1] = b + 24
+        dest[o + 2] = pulse_destination
+        dest[o + 3] = pulse_length
+        dest[o + 4] = pulse_stride
+        dest[o + 5] = b + 32
+        dest[o + 6] = pins[i]
+        dest[o + 7] = 0
+        # control block 2 - delay
+        dest[o + 8] = delay_info
+        dest[o + 9] = 0
+        dest[o + 10] = delay_destination
+        dest[o + 11] = lengths[i] << 4
+        dest[o + 12] = delay_stride
+        dest[o + 13] = b + 64
+        dest[o + 14] = 0
+        dest[o + 15] = 0
+        # control block 3 - clear
+        dest[o + 16] = pulse_info
+        dest[o + 17] = b + 88
+        dest[o + 18] = pulse_destination
+        dest[o + 19] = pulse_length
+        dest[o + 20] = pulse_stride
+        dest[o + 21] = b + 96
+        dest[o + 22] = 0
+        dest[o + 23] = pins[i]
+        if with_delays:
+            # control block 4 - delay after pulse
+            dest[o + 24] = delay_info
+            dest[o + 25] = b + 120
+            dest[o + 26] = delay_destination
+            dest[o + 27] = delays[i] << 4
+            dest[o + 28] = delay_stride
+            dest[o + 29] = b + 128
+            dest[o + 30] = 0
+            dest[o + 31] = 0
+
+
+if numba is not None:
+    _build_pulse_cbs = numba.njit(cache=True)(_build_pulse_cbs)
+
 
 class GPIO(object):
     MODE_OUTPUT = 1
     MODE_INPUT_NOPULL = 2
     MODE_INPUT_PULLUP = 3
     MODE_INPUT_PULLDOWN = 4
+    # mode to GPPUD register value
+    _PULL_ENCODING = {MODE_INPUT_NOPULL: 0, MODE_INPUT_PULLUP: 2,
+                      MODE_INPUT_PULLDOWN: 1}
 
     def __init__(self):
         """ Create object which can control GPIO.
@@ -19,17 +89,20 @@ class GPIO(object):
             libs or kernel modules.
         """
         self._mem = PhysicalMemory(PERI_BASE + GPIO_REGISTER_BASE)
+        # per pin (register address, bitmask) pairs, filled by init(). Having
+        # them precalculated makes set()/clear()/read() cheap enough for
+        # hot loops.
+        self._set_cache = dict()
+        self._clear_cache = dict()
+        self._read_cache = dict()
 
     def _pull_up_dn(self, pin, mode):
         p = self._mem.read_int(GPIO_PULLUPDN_OFFSET)
         p &= ~3
-        if mode == self.MODE_INPUT_PULLUP:
-            p |= 2
-        elif mode == self.MODE_INPUT_PULLDOWN:
-            p |= 1
+        p |= self._PULL_ENCODING.get(mode, 0)
         self._mem.write_int(GPIO_PULLUPDN_OFFSET, p)
-        address = 4 * int(pin / 32) + GPIO_PULLUPDNCLK_OFFSET
-        self._mem.write_int(address, 1 << (pin % 32))
+        address = 4 * (pin >> 5) + GPIO_PULLUPDNCLK_OFFSET
+        self._mem.write_int(address, 1 << (pin & 31))
         p = self._mem.read_int(GPIO_PULLUPDN_OFFSET)
         p &= ~3
         self._mem.write_int(GPIO_PULLUPDN_OFFSET, p)
@@ -40,7 +113,7 @@ class GPIO(object):
         :param pin: pin number.
         :param mode: one of MODE_* variables in this class.
         """
-        address = 4 * int(pin / 10) + GPIO_FSEL_OFFSET
+        address = 4 * (pin // 10) + GPIO_FSEL_OFFSET
         v = self._mem.read_int(address)
         v &= ~(7 << ((pin % 10) * 3))  # input value
         if mode == self.MODE_OUTPUT:
@@ -49,30 +122,34 @@ class GPIO(object):
         else:
             self._mem.write_int(address, v)
             self._pull_up_dn(pin, mode)
+        mask = 1 << (pin & 31)
+        bank = 4 * (pin >> 5)
+        self._set_cache[pin] = (bank + GPIO_SET_OFFSET, mask)
+        self._clear_cache[pin] = (bank + GPIO_CLEAR_OFFSET, mask)
+        self._read_cache[pin] = (bank + GPIO_INPUT_OFFSET, mask)
 
     def set(self, pin):
         """ Set pin to HIGH state.
         :param pin: pin number.
         """
-        address = 4 * int(pin / 32) + GPIO_SET_OFFSET
-        self._mem.write_int(address, 1 << (pin % 32))
+        address, mask = self._set_cache[pin]
+        self._mem.write_int(address, mask)
 
     def clear(self, pin):
         """ Set pin to LOW state.
         :param pin: pin number.
         """
-        address = 4 * int(pin / 32) + GPIO_CLEAR_OFFSET
-        self._mem.write_int(address, 1 << (pin % 32))
+        address, mask = self._clear_cache[pin]
+        self._mem.write_int(address, mask)
 
     def read(self, pin):
         """ Read pin current value.
         :param pin: pin number.
         :return: integer value 0 or 1.
         """
-        address = 4 * int(pin / 32) + GPIO_INPUT_OFFSET
+        address, mask = self._read_cache[pin]
         v = self._mem.read_int(address)
-        v &= 1 << (pin % 32)
-        if v == 0:
+        if v & mask == 0:
             return 0
         return 1
 
@@ -83,6 +160,12 @@ class GPIO(object):
 class DMAGPIO(DMAProto):
     _DMA_CONTROL_BLOCK_SIZE = 32
     _DMA_CHANNEL = 4
+    _PULSE_STRUCT = struct.Struct("<24I")
+    _DELAY_STRUCT = struct.Struct("<8I")
+    # small structs for patching template words
+    _U32 = struct.Struct("<I")
+    _2U32 = struct.Struct("<2I")
+    _3U32 = struct.Struct("<3I")
 
     def __init__(self):
         """ Create object which control GPIO pins via DMA(Direct Memory
@@ -96,6 +179,13 @@ class DMAGPIO(DMAProto):
         """
         super(DMAGPIO, self).__init__(30 * 1024 * 1024, self._DMA_CHANNEL)
         self.__current_address = 0
+        # persistent uint32 view over the control blocks buffer, None if
+        # numpy is not available
+        self._cb_view = self._phys_memory.as_ndarray()
+        # buffer parameters are constants, cache them to save two method
+        # calls per added control block
+        self._mem_size = self._phys_memory.get_size()
+        self._bus_address = self._phys_memory.get_bus_address()
 
         # get helpers registers, this class uses PWM module to create precise
         # delays
@@ -118,6 +208,32 @@ class DMAGPIO(DMAProto):
         self._pulse_stride = (DMA_TI_STRIDE_D_STRIDE(12)
                               | DMA_TI_STRIDE_S_STRIDE(4))
 
+        # prepacked control block templates, only position and parameter
+        # dependent words are patched before writing
+        self._pulse_template = bytearray(self._PULSE_STRUCT.pack(
+            self._pulse_info, 0, self._pulse_destination, self._pulse_length,
+            self._pulse_stride, 0, 0, 0,
+            self._delay_info, 0, self._delay_destination, 0,
+            self._delay_stride, 0, 0, 0,
+            self._pulse_info, 0, self._pulse_destination, self._pulse_length,
+            self._pulse_stride, 0, 0, 0))
+        self._delay_template = bytearray(self._DELAY_STRUCT.pack(
+            self._delay_info, 0, self._delay_destination, 0,
+            self._delay_stride, 0, 0, 0))
+        self._set_clear_template = bytearray(self._DELAY_STRUCT.pack(
+            self._pulse_info, 0, self._pulse_destination, self._pulse_length,
+            self._pulse_stride, 0, 0, 0))
+
+        # precomputed register values for run_stream(). Note: these writes
+        # can not be fused into one slice write, the clock divider must be
+        # written before the enable bit and PWM registers are not adjacent.
+        self._clock_disable = CM_PASSWORD | CM_SRC_PLLD
+        self._clock_divider = CM_PASSWORD | CM_DIV_VALUE(5)  # 100 MHz
+        self._clock_enable = CM_PASSWORD | CM_SRC_PLLD | CM_CNTL_ENABLE
+        self._pwm_dmac = (PWM_DMAC_ENAB | PWM_DMAC_PANIC(15)
+                          | PWM_DMAC_DREQ(15))
+        self._pwm_enable = PWM_CTL_USEF1 | PWM_CTL_PWEN1
+
     def add_pulse(self, pins_mask, length_us):
         """ Add single pulse at the current position.
             Note: GPIO pins are not initialized in this method and should be
@@ -127,45 +243,173 @@ class DMAGPIO(DMAProto):
             :param length_us: length in us.
         """
         next_cb = self.__current_address + 3 * self._DMA_CONTROL_BLOCK_SIZE
-        if next_cb > self._phys_memory.get_size():
+        if next_cb > self._mem_size:
             raise MemoryError("Out of allocated memory.")
-        next3 = next_cb + self._phys_memory.get_bus_address()
+        next3 = next_cb + self._bus_address
         next2 = next3 - self._DMA_CONTROL_BLOCK_SIZE
         next1 = next2 - self._DMA_CONTROL_BLOCK_SIZE
 
-        source1 = next1 - 8  # last 8 bytes are padding, use it to store data
-        length2 = length_us << 4  # * 16
-        source3 = next3 - 8
-
-        data = (
-            # control block 1 - set
-            self._pulse_info, source1, self._pulse_destination,
-            self._pulse_length, self._pulse_stride, next1, pins_mask, 0,
-            # control block 2 - delay
-            self._delay_info, 0, self._delay_destination, length2,
-            self._delay_stride, next2, 0, 0,
-            # control block 3 - clear
-            self._pulse_info, source3, self._pulse_destination,
-            self._pulse_length, self._pulse_stride, next3, 0, pins_mask
-                )
-        self._phys_memory.write(self.__current_address, "24I", data)
+        template = self._pulse_template
+        pack = self._U32.pack_into
+        # last 8 bytes of each block are padding, used to store data
+        pack(template, 4, next1 - 8)             # source 1
+        self._2U32.pack_into(template, 20, next1, pins_mask)
+        pack(template, 44, length_us << 4)       # length 2, * 16
+        pack(template, 52, next2)                # next 2
+        pack(template, 68, next3 - 8)            # source 3
+        pack(template, 84, next3)                # next 3
+        pack(template, 92, pins_mask)            # pins to clear
+        self._phys_memory.write_bytes(self.__current_address, template)
         self.__current_address = next_cb
 
+    def add_pulses(self, pins_masks, lengths_us, delays_us=None):
+        """ Add sequence of pulses at the current position.
+            Does the same as calling add_pulse(), optionally followed by
+            add_delay(), in a loop, but packs all control blocks into a
+            single buffer and writes it to physical memory at once. For
+            long sequences it is significantly faster.
+            :param pins_masks: list with bitwise mask of GPIO pins for each
+                               pulse. Only for first 32 pins.
+            :param lengths_us: list with length in us of each pulse.
+            :param delays_us: optional list with delay in us which follows
+                              each pulse.
+        """
+        cb_size = self._DMA_CONTROL_BLOCK_SIZE
+        pulse_size = 3 * cb_size
+        entry_size = pulse_size
+        if delays_us is not None:
+            entry_size += cb_size
+        total_size = len(pins_masks) * entry_size
+        if self.__current_address + total_size \
+                > self._mem_size:
+            raise MemoryError("Out of allocated memory.")
+        if numpy is not None:
+            self.__add_pulses_np(pins_masks, lengths_us, delays_us,
+                                 entry_size)
+            return
+        buf = bytearray(total_size)
+        bus_address = self._bus_address
+        pack_pulse = self._PULSE_STRUCT.pack_into
+        pack_delay = self._DELAY_STRUCT.pack_into
+        address = self.__current_address
+        offset = 0
+        for i in range(len(pins_masks)):
+            pins_mask = pins_masks[i]
+            next3 = address + pulse_size + bus_address
+            next2 = next3 - cb_size
+            next1 = next2 - cb_size
+            pack_pulse(
+                buf, offset,
+                # control block 1 - set
+                self._pulse_info, next1 - 8, self._pulse_destination,
+                self._pulse_length, self._pulse_stride, next1, pins_mask, 0,
+                # control block 2 - delay
+                self._delay_info, 0, self._delay_destination,
+                lengths_us[i] << 4, self._delay_stride, next2, 0, 0,
+                # control block 3 - clear
+                self._pulse_info, next3 - 8, self._pulse_destination,
+                self._pulse_length, self._pulse_stride, next3, 0, pins_mask
+            )
+            address += pulse_size
+            offset += pulse_size
+            if delays_us is not None:
+                next1 = address + cb_size + bus_address
+                pack_delay(
+                    buf, offset,
+                    self._delay_info, next1 - 8, self._delay_destination,
+                    delays_us[i] << 4, self._delay_stride, next1, 0, 0
+                )
+                address += cb_size
+                offset += cb_size
+        self._phys_memory.write_bytes(self.__current_address, buf)
+        self.__current_address = address
+
+    def __add_pulses_np(self, pins_masks, lengths_us, delays_us, entry_size):
+        """ Vectorized backend for add_pulses(), used when numpy is
+            available. Every field of a control block is either constant or
+            a linear function of the block address, so whole columns are
+            filled with broadcasting instead of packing blocks one by one.
+        """
+        cb_size = self._DMA_CONTROL_BLOCK_SIZE
+        n = len(pins_masks)
+        if numba is not None and self._cb_view is not None:
+            lengths = numpy.asarray(lengths_us, dtype=numpy.uint32)
+            if delays_us is not None:
+                delays = numpy.asarray(delays_us, dtype=numpy.uint32)
+            else:
+                delays = lengths  # not used, numba needs an array anyway
+            _build_pulse_cbs(self._cb_view, self.__current_address >> 2,
+                             self.__current_address
+                             + self._bus_address,
+                             numpy.asarray(pins_masks, dtype=numpy.uint32),
+                             lengths, delays, delays_us is not None,
+                             entry_size >> 2, self._pulse_info,
+                             self._pulse_destination, self._pulse_length,
+                             self._pulse_stride, self._delay_info,
+                             self._delay_destination, self._delay_stride)
+            self.__current_address += n * entry_size
+            return
+        # bus address of the first control block of each entry
+        base = (self.__current_address + self._bus_address
+                + numpy.arange(n, dtype="<u4") * entry_size)
+        pins = numpy.asarray(pins_masks, dtype="<u4")
+        cb = numpy.empty((n, entry_size >> 2), dtype="<u4")
+        # control block 1 - set
+        cb[:, 0] = self._pulse_info
+        cb[:, 1] = base + cb_size - 8
+        cb[:, 2] = self._pulse_destination
+        cb[:, 3] = self._pulse_length
+        cb[:, 4] = self._pulse_stride
+        cb[:, 5] = base + cb_size
+        cb[:, 6] = pins
+        cb[:, 7] = 0
+        # control block 2 - delay
+        cb[:, 8] = self._delay_info
+        cb[:, 9] = 0
+        cb[:, 10] = self._delay_destination
+        cb[:, 11] = numpy.asarray(lengths_us, dtype="<u4") << 4
+        cb[:, 12] = self._delay_stride
+        cb[:, 13] = base + 2 * cb_size
+        cb[:, 14] = 0
+        cb[:, 15] = 0
+        # control block 3 - clear
+        cb[:, 16] = self._pulse_info
+        cb[:, 17] = base + 3 * cb_size - 8
+        cb[:, 18] = self._pulse_destination
+        cb[:, 19] = self._pulse_length
+        cb[:, 20] = self._pulse_stride
+        cb[:, 21] = base + 3 * cb_size
+        cb[:, 22] = 0
+        cb[:, 23] = pins
+        if delays_us is not None:
+            # control block 4 - delay after pulse
+            cb[:, 24] = self._delay_info
+            cb[:, 25] = base + 4 * cb_size - 8
+            cb[:, 26] = self._delay_destination
+            cb[:, 27] = numpy.asarray(delays_us, dtype="<u4") << 4
+            cb[:, 28] = self._delay_stride
+            cb[:, 29] = base + 4 * cb_size
+            cb[:, 30] = 0
+            cb[:, 31] = 0
+        # assign through the persistent view, no intermediate bytes object
+        start = self.__current_address >> 2
+        self._cb_view[start:start + cb.size] = cb.ravel()
+        self.__current_address += n * entry_size
+
     def add_delay(self, delay_us):
         """ Add delay at the current position.
             :param delay_us: delay in us.
         """
         next_cb = self.__current_address + self._DMA_CONTROL_BLOCK_SIZE
-        if next_cb > self._phys_memory.get_size():
+        if next_cb > self._mem_size:
             raise MemoryError("Out of allocated memory.")
-        next1 = self._phys_memory.get_bus_address() + next_cb
-        source = next1 - 8  # last 8 bytes are padding, use it to store data
-        length = delay_us << 4  # * 16
-        data = (
-                self._delay_info, source, self._delay_destination, length,
-                self._delay_stride, next1, 0, 0
-               )
-        self._phys_memory.write(self.__current_address, "8I", data)
+        next1 = self._bus_address + next_cb
+        template = self._delay_template
+        # last 8 bytes are padding, use it to store data
+        self._U32.pack_into(template, 4, next1 - 8)       # source
+        self._U32.pack_into(template, 12, delay_us << 4)  # length, * 16
+        self._U32.pack_into(template, 20, next1)          # next
+        self._phys_memory.write_bytes(self.__current_address, template)
         self.__current_address = next_cb
 
     def add_set_clear(self, pins_to_set, pins_to_clear):
@@ -174,16 +418,14 @@ class DMAGPIO(DMAProto):
         :param pins_to_clear: bitwise mask which pins should be clear.
         """
         next_cb = self.__current_address + self._DMA_CONTROL_BLOCK_SIZE
-        if next_cb > self._phys_memory.get_size():
+        if next_cb > self._mem_size:
             raise MemoryError("Out of allocated memory.")
-        next1 = self._phys_memory.get_bus_address() + next_cb
-        source = next1 - 8  # last 8 bytes are padding, use it to store data
-        data = (
-                self._pulse_info, source, self._pulse_destination,
-                self._pulse_length, self._pulse_stride, next1,
-                pins_to_set, pins_to_clear
-               )
-        self._phys_memory.write(self.__current_address, "8I", data)
+        next1 = self._bus_address + next_cb
+        template = self._set_clear_template
+        # last 8 bytes are padding, use it to store data
+        self._U32.pack_into(template, 4, next1 - 8)  # source
+        self._3U32.pack_into(template, 20, next1, pins_to_set, pins_to_clear)
+        self._phys_memory.write_bytes(self.__current_address, template)
         self.__current_address = next_cb
 
     def finalize_stream(self):
@@ -199,21 +441,28 @@ class DMAGPIO(DMAProto):
             and do not check if there is anything to do.
         """
         # configure PWM hardware module which will clocks DMA
-        self._pwm.write_int(PWM_CTL, 0)
+        pwm_write = self._pwm.write_int
+        clock_write = self._clock.write_int
+        pwm_write(PWM_CTL, 0)
         # disable
-        self._clock.write_int(CM_PWM_CNTL, CM_PASSWORD | CM_SRC_PLLD)
+        clock_write(CM_PWM_CNTL, self._clock_disable)
+        # wait until BUSY bit is clear. The clock stops in a fraction of
+        # microsecond, while sleep() parks the process for at least a
+        # scheduler tick, so spin on the register. The spin is bounded in
+        # case the clock module is in a bad state and the bit never
+        # clears, then yield the CPU between reads.
+        spins = 1000
         while (self._clock.read_int(CM_PWM_CNTL) & CM_CNTL_BUSY) != 0:
-            time.sleep(0.00001)  # 10 us, wait until BUSY bit is clear
-        # configure, 100 MHz
-        self._clock.write_int(CM_PWM_DIV, CM_PASSWORD | CM_DIV_VALUE(5))
-        self._clock.write_int(CM_PWM_CNTL,
-                              CM_PASSWORD | CM_SRC_PLLD | CM_CNTL_ENABLE)
-        self._pwm.write_int(PWM_RNG1, 100)
-        self._pwm.write_int(PWM_DMAC, PWM_DMAC_ENAB | PWM_DMAC_PANIC(15)
-                            | PWM_DMAC_DREQ(15))
-        self._pwm.write_int(PWM_CTL, PWM_CTL_CLRF)
+            spins -= 1
+            if spins <= 0:
+                time.sleep(0)
+        clock_write(CM_PWM_DIV, self._clock_divider)
+        clock_write(CM_PWM_CNTL, self._clock_enable)
+        pwm_write(PWM_RNG1, 100)
+        pwm_write(PWM_DMAC, self._pwm_dmac)
+        pwm_write(PWM_CTL, PWM_CTL_CLRF)
         # enable
-        self._pwm.write_int(PWM_CTL, PWM_CTL_USEF1 | PWM_CTL_PWEN1)
+        pwm_write(PWM_CTL, self._pwm_enable)
         super(DMAGPIO, self)._run_dma()
 
     def run(self, loop=False):
@@ -226,7 +475,7 @@ class DMAGPIO(DMAProto):
         if loop:
             self._phys_memory.write_int(self.__current_address + 20
                                         - self._DMA_CONTROL_BLOCK_SIZE,
-                                        self._phys_memory.get_bus_address())
+                                        self._bus_address)
         else:
             self.finalize_stream()
         self.run_stream()
@@ -292,7 +541,7 @@ class DMAPWM(DMAProto):
 
     def __add_control_block(self, address, offset):
         ba = self._phys_memory.get_bus_address() + address
-        data = (
+        data = array.array("I", (
             DMA_TI_NO_WIDE_BURSTS | DMA_TI_WAIT_RESP
             | DMA_TI_DEST_INC | DMA_TI_SRC_INC,  # info
             ba + self._DMA_DATA_OFFSET,  # source, use padding for storing data
@@ -302,8 +551,8 @@ class DMAPWM(DMAProto):
             ba + self._DMA_CONTROL_BLOCK_SIZE,  # next control block
             0,  # padding, uses as data storage
             0  # padding
-        )
-        self._phys_memory.write(address, "8I", data)
+        ))
+        self._phys_memory.write_words(address, data)
 
     def add_pin(self, pin, duty_cycle):
         """ Add pin to PMW with specified duty cycle.
@@ -376,26 +625,26 @@ class DMAWatchdog(DMAProto):
         GPIO pins 0-29 will be switched to input to prevent any output from
         them.
         """
-        data = ()
+        data = array.array("I")
         ba = self._phys_memory.get_bus_address()
         # first blocks is just a delay
         for _ in range(0, self._DMA_BLOCKS):
-            data += (
+            data.extend((
                 DMA_TI_NO_WIDE_BURSTS | DMA_DEST_IGNORE | DMA_TI_WAIT_RESP
                 | DMA_TI_WAITS(31),
                 ba + 24, ba + 28, 65535,
                 0, ba + self._DMA_CONTROL_BLOCK_SIZE, 0, 0
-            )
+            ))
             ba += self._DMA_CONTROL_BLOCK_SIZE
         # The last block writes zeros(switches to input state) in GPIO's FSEL
         # registers. In normal operating should never be called until watchdog
         # timeout is reached.
-        data += (
+        data.extend((
             DMA_TI_NO_WIDE_BURSTS | DMA_TI_WAIT_RESP | DMA_TI_DEST_INC,
             ba + 24, PHYSICAL_GPIO_BUS + GPIO_FSEL_OFFSET, 12,
             0, 0, 0, 0
-        )
-        self._phys_memory.write(0, str(len(data)) + "I", data)
+        ))
+        self._phys_memory.write_words(0, data)
         super(DMAWatchdog, self)._run_dma()
 
     def stop(self):
@@ -7,6 +7,11 @@ import array
 import atexit
 import ctypes
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Raspberry Pi registers
 # https://www.raspberrypi.org/wp-content/uploads/2012/02/BCM2835-ARM-Peripherals.pdf
 RPI1_PERI_BASE = 0x20000000
@@ -119,10 +124,21 @@ class PhysicalMemory(object):
                                  prot=mmap.PROT_READ | mmap.PROT_WRITE,
                                  offset=phys_address)
         self._close_dev(fd)
+        # persistent uint32 view over the mapping, it saves creation of a
+        # temporary buffer object on each register access
+        self._words = memoryview(self._memmap).cast("I")
+        self._np_view = None
         atexit.register(self.cleanup)
 
     def cleanup(self):
-        self._memmap.close()
+        self._np_view = None
+        self._words.release()
+        try:
+            self._memmap.close()
+        except BufferError:
+            # some exported view is still referenced somewhere, mapping
+            # will be dropped with the process anyway
+            pass
 
     @staticmethod
     def _open_dev(name):
@@ -136,17 +152,35 @@ class PhysicalMemory(object):
         os.close(fd)
 
     def write_int(self, address, int_value):
-        ctypes.c_uint32.from_buffer(self._memmap, address).value = int_value
+        self._words[address >> 2] = int_value
 
     def write(self, address, fmt, data):
         struct.pack_into(fmt, self._memmap, address, *data)
 
+    def write_bytes(self, address, data):
+        self._memmap[address:address + len(data)] = data
+
+    def write_words(self, address, words):
+        """ Write array.array('I') of 32 bit words, avoiding per-word
+            packing.
+        """
+        start = address >> 2
+        self._words[start:start + len(words)] = memoryview(words)
+
     def read_int(self, address):
-        return ctypes.c_uint32.from_buffer(self._memmap, address).value
+        return self._words[address >> 2]
 
     def get_size(self):
         return self._size
 
+    def as_ndarray(self):
+        """ Get persistent numpy uint32 view over the whole mapping.
+        :return: numpy array or None if numpy is not available.
+        """
+        if self._np_view is None and numpy is not None:
+            self._np_view = numpy.frombuffer(self._memmap, dtype="<u4")
+        return self._np_view
+
 
 class CMAPhysicalMemory(PhysicalMemory):
     IOCTL_MBOX_PROPERTY = ctypes.c_long(0xc0046400).value
@@ -1,31 +1,69 @@
 #!/usr/bin/env python
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import urllib.parse as urlparse
+import socketserver
+import threading
 import json
+import os
 
 import cnc.logging_config as logging_config
 from cnc.gcode import GCode, GCodeException
 from cnc.gmachine import GMachine, GMachineException
 
 machine = GMachine()
+# machine executes one command at a time, concurrent connections have to
+# wait in queue for this lock
+machine_lock = threading.Lock()
+# prepared parser and dispatcher, saves attribute lookups on each line
+parse_line = GCode.parse_line
+do_command = machine.do_command
 
 
 def do_line(line):
     try:
-        g = GCode.parse_line(line)
-        res = machine.do_command(g)
+        g = parse_line(line)
+        with machine_lock:
+            res = do_command(g)
     except (GCodeException, GMachineException) as e:
         print('ERROR ' + str(e))
-        return False
+        return 'ERROR ' + str(e)
     if res is not None:
         return 'OK ' + res
     else:
         return 'OK'
-    return True
 
 
 class GetHandler(BaseHTTPRequestHandler):
+    # keep connections alive, so a client streaming gcode line by line
+    # doesn't pay for a new TCP connection on each command
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # buffer for composing responses, reused for all requests coming
+        # through this connection
+        self._response_buffer = bytearray()
+
+    def _respond(self, code, message, body):
+        """ Send status line, headers and body with a single socket write.
+            wfile is unbuffered, so going through send_response()/
+            end_headers()/wfile.write(body) costs a syscall and a TCP
+            segment for each part.
+        """
+        self.log_request(code)
+        headers = ("%s %d %s\r\n"
+                   "Server: %s\r\n"
+                   "Date: %s\r\n"
+                   "Content-Length: %d\r\n"
+                   "\r\n" % (self.protocol_version, code, message,
+                             self.version_string(),
+                             self.date_time_string(), len(body)))
+        buf = self._response_buffer
+        del buf[:]
+        buf += headers.encode("latin-1")
+        buf += body
+        self.wfile.write(buf)
 
     def do_GET(self):
         parsed_path = urlparse.urlparse(self.path)
@@ -33,26 +71,52 @@ class GetHandler(BaseHTTPRequestHandler):
         query = urlparse.parse_qs(parsed_path.query)
         command = query["cmd"][0]
         if command:
-            response = do_line(command)
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(bytes(response, "utf-8"))
+            self._respond(200, "OK", bytes(do_line(command), "utf-8"))
         else:
-            self.send_response(400)
-            self.end_headers()
-            self.wfile.write(b"Bad Request")
+            self._respond(400, "Bad Request", b"Bad Request")
         return
 
+
+class StreamHandler(socketserver.StreamRequestHandler):
+    """ Line protocol over a UNIX domain socket: client sends one gcode
+        command per line and receives one 'OK ...' or 'ERROR ...' line per
+        command. For high rate gcode streaming this skips HTTP parsing and
+        header composing completely.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode("utf-8", "replace").strip()
+            if not line:
+                continue
+            self.wfile.write(bytes(do_line(line) + "\n", "utf-8"))
+
+
 def main():
     logging_config.debug_disable()
+    SOCKET_PATH = "/tmp/pycnc.sock"
+    stream_server = None
     try:
         PORT = 10913
-        server = HTTPServer(('localhost', PORT), GetHandler)
+        server = ThreadingHTTPServer(('localhost', PORT), GetHandler)
         print(f'Starting server at http://localhost:{PORT}')
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
+        stream_server = socketserver.ThreadingUnixStreamServer(SOCKET_PATH,
+                                                               StreamHandler)
+        stream_server.daemon_threads = True
+        stream_thread = threading.Thread(target=stream_server.serve_forever)
+        stream_thread.daemon = True
+        stream_thread.start()
+        print(f'Listening for gcode lines at {SOCKET_PATH}')
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     print("\r\nExiting...")
+    if stream_server is not None:
+        stream_server.shutdown()
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
     machine.release()
 
 